@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
+import os
+import re
 import sys
 import math
+import shutil
+import hashlib
+import zipfile
 import time
+import urllib.error
+import urllib.parse
 import urllib.request
-import xml.etree.ElementTree as ET
+import urllib3
+from xml.sax.saxutils import XMLGenerator
+from lxml import etree
+from dataclasses import dataclass
 from datetime import datetime, timezone
 # Very rough centroids for US states (lat, lon)
 STATE_CENTROIDS = {
@@ -59,16 +69,56 @@ STATE_CENTROIDS = {
     "WY": (42.755966, -107.302490),
 }
 
+# Whole-word state code in an areaDesc, e.g. "Harris, TX" but not the "IN" in "PRINCE"
+STATE_RE = re.compile(r"\b(" + "|".join(STATE_CENTROIDS) + r")\b")
+
 ATOM_NS = "http://www.w3.org/2005/Atom"
 GEORSS_NS = "http://www.georss.org/georss"
 CAP_NS = "urn:oasis:names:tc:emergency:cap:1.2"
 KML_NS = "http://www.opengis.net/kml/2.2"
 
 
-NS = {"atom": ATOM_NS, "georss": GEORSS_NS, "cap": CAP_NS}
+# Qualified tag names, precomputed so lookups skip prefix resolution
+Q_ENTRY = f"{{{ATOM_NS}}}entry"
+Q_ID = f"{{{ATOM_NS}}}id"
+Q_TITLE = f"{{{ATOM_NS}}}title"
+Q_UPDATED = f"{{{ATOM_NS}}}updated"
+Q_SUMMARY = f"{{{ATOM_NS}}}summary"
+Q_POINT = f"{{{GEORSS_NS}}}point"
+Q_POLYGON = f"{{{GEORSS_NS}}}polygon"
+Q_EVENT = f"{{{CAP_NS}}}event"
+Q_EFFECTIVE = f"{{{CAP_NS}}}effective"
+Q_EXPIRES = f"{{{CAP_NS}}}expires"
+Q_URGENCY = f"{{{CAP_NS}}}urgency"
+Q_SEVERITY = f"{{{CAP_NS}}}severity"
+Q_CERTAINTY = f"{{{CAP_NS}}}certainty"
+Q_AREADESC = f"{{{CAP_NS}}}areaDesc"
+Q_HEADLINE = f"{{{CAP_NS}}}headline"
+Q_DESCRIPTION = f"{{{CAP_NS}}}description"
+Q_INSTRUCTION = f"{{{CAP_NS}}}instruction"
+
+# Entry child tag → Entry attribute filled by extract_entry
+ENTRY_FIELDS = {
+    Q_ID: "id",
+    Q_TITLE: "title",
+    Q_UPDATED: "updated",
+    Q_SUMMARY: "summary",
+    # CAP fields
+    Q_EVENT: "event",
+    Q_EFFECTIVE: "effective",
+    Q_EXPIRES: "expires",
+    Q_URGENCY: "urgency",
+    Q_SEVERITY: "severity",
+    Q_CERTAINTY: "certainty",
+    Q_AREADESC: "areaDesc",
+    Q_HEADLINE: "headline",
+    Q_DESCRIPTION: "description",
+    Q_INSTRUCTION: "instruction",
+}
 
 
 FEED_URL = "https://api.weather.gov/alerts/active.atom"
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "capkml")
 
 
 # Map CAP severity → icon color
@@ -80,19 +130,103 @@ SEVERITY_ICON = {
 }
 DEFAULT_ICON = "http://maps.google.com/mapfiles/kml/paddle/wht-circle.png"
 
+# CAP severity → placemark styleUrl; anything else (including missing) uses "Unknown"
+STYLE_URL = {sev: f"#sev_{sev.lower()}" for sev in (*SEVERITY_ICON, "Unknown")}
 
 
 
-def http_get(url: str, timeout=30) -> bytes:
-    req = urllib.request.Request(
-        url,
-        headers={
-            "User-Agent": "CAP-KML/1.0 (+https://github.com/jeandeauxmail-cell/alertstest)",
-            "Accept": "application/atom+xml,application/xml,text/xml",
-        },
-    )
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return resp.read()
+
+HTTP_HEADERS = {
+    "User-Agent": "CAP-KML/1.0 (+https://github.com/jeandeauxmail-cell/alertstest)",
+    "Accept": "application/atom+xml,application/xml,text/xml",
+    "Accept-Encoding": "gzip",
+}
+
+# Separate connect and read limits for every feed request
+HTTP_TIMEOUT = urllib3.Timeout(connect=5, read=30)
+
+# Pool managers keyed by proxy URL (None = direct); each keeps its connections alive across calls
+_managers = {}
+
+
+def _pool_manager(url: str):
+    """Return the pool manager for url, honouring $HTTPS_PROXY/$HTTP_PROXY and $NO_PROXY."""
+    parts = urllib.parse.urlsplit(url)
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if proxy and urllib.request.proxy_bypass(parts.hostname or ""):
+        proxy = None
+    manager = _managers.get(proxy)
+    if manager is None:
+        manager = _managers[proxy] = urllib3.ProxyManager(proxy) if proxy else urllib3.PoolManager()
+    return manager
+
+
+def http_get(url: str, timeout=HTTP_TIMEOUT, headers=None):
+    """GET url (following redirects) and return the unread urllib3 response.
+    Both 200 and 304 responses are returned; the body is decoded (gzip) as it is read.
+    Read it to the end and call release_conn() so the connection goes back to the pool.
+    """
+    headers = {**HTTP_HEADERS, **headers} if headers else HTTP_HEADERS
+    resp = _pool_manager(url).request("GET", url, headers=headers, timeout=timeout, preload_content=False)
+    if resp.status not in (200, 304):
+        # Discard the connection rather than pool it with an unread error body
+        resp.close()
+        resp.release_conn()
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return resp
+
+
+# Cache file suffix → (response header to store, request header to send it back in)
+VALIDATORS = {
+    ".etag": ("ETag", "If-None-Match"),
+    ".lastmod": ("Last-Modified", "If-Modified-Since"),
+}
+
+
+def fetch_cached(url: str):
+    """Conditionally GET url against the copy kept in CACHE_DIR and return the path of
+    the cached body. On HTTP 304 the body file is left untouched, so its mtime records
+    when the feed last changed.
+    """
+    base = os.path.join(CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest())
+    body_path = base + ".body"
+    headers = {}
+    if os.path.exists(body_path):
+        for suffix, (_, request_header) in VALIDATORS.items():
+            try:
+                with open(base + suffix, encoding="utf-8") as f:
+                    headers[request_header] = f.read()
+            except FileNotFoundError:
+                pass
+
+    resp = http_get(url, headers=headers)
+    try:
+        if resp.status == 304:
+            resp.read()
+            return body_path
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Drop the old validators first so they can never be paired with a newer body
+        for suffix in VALIDATORS:
+            try:
+                os.remove(base + suffix)
+            except FileNotFoundError:
+                pass
+        # The cache always holds the decoded feed, so 304 reuse needs no encoding info
+        with open(body_path + ".tmp", "wb") as f:
+            shutil.copyfileobj(resp, f)
+        os.replace(body_path + ".tmp", body_path)
+        for suffix, (response_header, _) in VALIDATORS.items():
+            value = resp.headers.get(response_header)
+            if value:
+                with open(base + suffix, "w", encoding="utf-8") as f:
+                    f.write(value)
+    except BaseException:
+        # Never return a half-read connection to the pool
+        resp.close()
+        raise
+    finally:
+        resp.release_conn()
+    return body_path
 
 
 
@@ -104,33 +238,32 @@ def polygon_centroid(latlons):
 
     if not latlons:
         return None
-    # Convert to (x=lon, y=lat)
-    pts = [(p[1], p[0]) for p in latlons]
+    # Single pass over (lat, lon) = (y, x) pairs; also sums the vertices for the fallback
     a = 0.0
     cx = 0.0
     cy = 0.0
-    for i in range(len(pts)):
-        x1, y1 = pts[i]
-        x2, y2 = pts[(i + 1) % len(pts)]
+    sx = 0.0
+    sy = 0.0
+    # Pair each vertex with the next one, wrapping the last back to the first
+    for (y1, x1), (y2, x2) in zip(latlons, latlons[1:] + latlons[:1]):
         cross = x1 * y2 - x2 * y1
         a += cross
         cx += (x1 + x2) * cross
         cy += (y1 + y2) * cross
+        sx += x1
+        sy += y1
     if abs(a) < 1e-9:
         # Degenerate → mean
-        lat = sum(p[0] for p in latlons) / len(latlons)
-        lon = sum(p[1] for p in latlons) / len(latlons)
-        return (lat, lon)
-    a *= 0.5
-    cx /= (6 * a)
-    cy /= (6 * a)
-    # back to (lat, lon) = (y, x)
-    return (cy, cx)
-
-def parse_point_from_entry(entry: ET.Element):
+        n = len(latlons)
+        return (sy / n, sx / n)
+    # a is twice the signed area, so 1 / (6 * area) == 1 / (3 * a)
+    scale = 1.0 / (3.0 * a)
+    return (cy * scale, cx * scale)
+
+def parse_point_from_entry(entry: etree._Element, area_desc: str):
     # Prefer georss:point
     """
-    p = entry.find("georss:point", NS)
+    p = entry.find(Q_POINT)
     if p is not None and p.text:
         try:
             lat_str, lon_str = p.text.strip().split()
@@ -139,7 +272,7 @@ def parse_point_from_entry(entry: ET.Element):
             pass
 
     # Else try georss:polygon centroid
-    poly = entry.find("georss:polygon", NS)
+    poly = entry.find(Q_POLYGON)
     if poly is not None and poly.text:
         nums = poly.text.strip().split()
         try:
@@ -149,38 +282,110 @@ def parse_point_from_entry(entry: ET.Element):
             pass
     """
     # Fallback: areaDesc lookup
-    area_desc = text_of(entry, "cap:areaDesc")
-    if area_desc:
-        for state, centroid in STATE_CENTROIDS.items():
-            if state in area_desc:
-                return centroid
+    m = STATE_RE.search(area_desc)
+    if m:
+        return STATE_CENTROIDS[m.group(1)]
 
     return None
 
-def text_of(el: ET.Element, path: str) -> str:
-    node = el.find(path, NS)
-    return node.text.strip() if node is not None and node.text else ""
+@dataclass(slots=True)
+class Entry:
+    """Fields of one feed entry; text fields missing from the feed are ""."""
+    id: str = ""
+    title: str = ""
+    updated: str = ""
+    summary: str = ""
+    # CAP fields
+    event: str = ""
+    effective: str = ""
+    expires: str = ""
+    urgency: str = ""
+    severity: str = ""
+    certainty: str = ""
+    areaDesc: str = ""
+    headline: str = ""
+    description: str = ""
+    instruction: str = ""
+    point: tuple | None = None # (lat, lon) once placed
+
+def extract_entry(entry: etree._Element) -> Entry:
+    """Return the ENTRY_FIELDS of an atom entry, in one pass over its children.
+    The first occurrence of a field wins.
+    """
+    data = Entry()
+    for child in entry:
+        key = ENTRY_FIELDS.get(child.tag)
+        if key and child.text and not getattr(data, key):
+            setattr(data, key, child.text.strip())
+    return data
+
+def is_newer(a: Entry, b: Entry) -> bool:
+    """True if entry a has a later atom:updated than entry b.
+    Compares as datetimes since the feed mixes UTC offsets; falls back to string order.
+    """
+    try:
+        return datetime.fromisoformat(a.updated) > datetime.fromisoformat(b.updated)
+    except (ValueError, TypeError):
+        return a.updated > b.updated
+
+# ExtendedData name → Entry attribute, in output order (names match the balloon template)
+EXT_FIELDS = (
+    ("ext_event", "event"),
+    ("ext_severity", "severity"),
+    ("ext_urgency", "urgency"),
+    ("ext_certainty", "certainty"),
+    ("ext_effective", "effective"),
+    ("ext_expires", "expires"),
+    ("ext_areaDesc", "areaDesc"),
+    ("ext_description", "description"),
+    ("ext_instruction", "instruction"),
+    ("ext_id", "id"),
+)
+
+# Newline + indentation for each nesting depth of the KML output
+INDENT = ["\n" + " " * depth for depth in range(8)]
+
+
+def _start(g: XMLGenerator, depth: int, name: str, attrs=None):
+    g.ignorableWhitespace(INDENT[depth])
+    g.startElement(name, attrs or {})
+
+
+def _end(g: XMLGenerator, depth: int, name: str):
+    g.ignorableWhitespace(INDENT[depth])
+    g.endElement(name)
+
+
+def _leaf(g: XMLGenerator, depth: int, name: str, text: str, attrs=None):
+    g.ignorableWhitespace(INDENT[depth])
+    g.startElement(name, attrs or {})
+    g.characters(text)
+    g.endElement(name)
 
-def build_kml(entries):
-    ET.register_namespace("", KML_NS)
-    kml = ET.Element(ET.QName(KML_NS, "kml"))
-    doc = ET.SubElement(kml, "Document")
-    ET.SubElement(doc, "name").text = "NOAA Active Alerts (Points)"
+
+def write_kml(entries, f):
+    """Stream the KML document for entries to binary file f, one placemark at a time."""
+    g = XMLGenerator(f, "utf-8", short_empty_elements=True)
+    g.startDocument()
+    g.startElement("kml", {"xmlns": KML_NS})
+    _start(g, 1, "Document")
+    _leaf(g, 2, "name", "NOAA Active Alerts (Points)")
     for sev, icon in {**SEVERITY_ICON, "Unknown": DEFAULT_ICON}.items():
-        sid = f"sev_{sev.lower()}"
-        st = ET.SubElement(doc, "Style", id=sid)
-        istyle = ET.SubElement(st, "IconStyle")
-        ET.SubElement(istyle, "scale").text = "1.2"
-        icon_el = ET.SubElement(istyle, "Icon")
-        ET.SubElement(icon_el, "href").text = icon
-        lstyle = ET.SubElement(st, "LabelStyle")
-        ET.SubElement(lstyle, "scale").text = "0.9"
-
-
-# Balloon template (uses ExtendedData)
-    bst = ET.SubElement(doc, "Style", id="balloon")
-    b = ET.SubElement(bst, "BalloonStyle")
-    b.text = (
+        _start(g, 2, "Style", {"id": f"sev_{sev.lower()}"})
+        _start(g, 3, "IconStyle")
+        _leaf(g, 4, "scale", "1.2")
+        _start(g, 4, "Icon")
+        _leaf(g, 5, "href", icon)
+        _end(g, 4, "Icon")
+        _end(g, 3, "IconStyle")
+        _start(g, 3, "LabelStyle")
+        _leaf(g, 4, "scale", "0.9")
+        _end(g, 3, "LabelStyle")
+        _end(g, 2, "Style")
+
+    # Balloon template (uses ExtendedData)
+    _start(g, 2, "Style", {"id": "balloon"})
+    _leaf(g, 3, "BalloonStyle", (
         "<![CDATA["
         "<div style='font-family:Arial, sans-serif;'>"
         "<h3>$[name]</h3>"
@@ -194,84 +399,82 @@ def build_kml(entries):
         "<p><a href='$[ext_id]' target='_blank'>Alert Link</a></p>"
         "</div>"
         "]]>"
-    )
+    ))
+    _end(g, 2, "Style")
+
     for e in entries:
-        pt = e["point"]
-        sev = e.get("severity") or "Unknown"
-        style_url = f"#sev_{sev.lower()}"
-        
-        
-        pm = ET.SubElement(doc, "Placemark")
-        ET.SubElement(pm, "name").text = e.get("title") or e.get("event") or "Alert"
-        ET.SubElement(pm, "styleUrl").text = style_url
+        pt = e.point
+        style_url = STYLE_URL.get(e.severity, STYLE_URL["Unknown"])
+
+        _start(g, 2, "Placemark")
+        _leaf(g, 3, "name", e.title or e.event or "Alert")
+        _leaf(g, 3, "styleUrl", style_url)
         # Pair with balloon style via StyleMap (inline)
-        sm = ET.SubElement(pm, "Style")
-        ET.SubElement(sm, "BalloonStyle") # presence triggers use of document balloon style
-        ET.SubElement(pm, "Snippet").text = e.get("headline") or e.get("summary") or ""
-        
-        
-        ext = ET.SubElement(pm, "ExtendedData")
-        def add_data(name, value):
-            d = ET.SubElement(ext, "Data", name=name)
-            ET.SubElement(d, "value").text = value or ""
-        
-        
-        add_data("ext_event", e.get("event"))
-        add_data("ext_severity", e.get("severity"))
-        add_data("ext_urgency", e.get("urgency"))
-        add_data("ext_certainty", e.get("certainty"))
-        add_data("ext_effective", e.get("effective"))
-        add_data("ext_expires", e.get("expires"))
-        add_data("ext_areaDesc", e.get("areaDesc"))
-        add_data("ext_description", e.get("description"))
-        add_data("ext_instruction", e.get("instruction"))
-        add_data("ext_id", e.get("id"))
-        
-        
-        pt_el = ET.SubElement(pm, "Point")
-        ET.SubElement(pt_el, "coordinates").text = f"{pt[1]},{pt[0]},0"
-        
-        
-    return ET.ElementTree(kml)
-
-def main(out_path: str):
-    raw = http_get(FEED_URL)
-    root = ET.fromstring(raw)
-    entries_xml = root.findall("atom:entry", NS)
-    
-    
-    entries = []
-    for entry in entries_xml:
-        point = parse_point_from_entry(entry)
-        if not point:
-            continue # skip if we can't place it
-        data = {
-            "point": point,
-            "id": text_of(entry, "atom:id"),
-            "title": text_of(entry, "atom:title"),
-            "updated": text_of(entry, "atom:updated"),
-            "summary": text_of(entry, "atom:summary"),
-            # CAP fields
-            "event": text_of(entry, "cap:event"),
-            "effective": text_of(entry, "cap:effective"),
-            "expires": text_of(entry, "cap:expires"),
-            "urgency": text_of(entry, "cap:urgency"),
-            "severity": text_of(entry, "cap:severity"),
-            "certainty": text_of(entry, "cap:certainty"),
-            "areaDesc": text_of(entry, "cap:areaDesc"),
-            "headline": text_of(entry, "cap:headline"),
-            "description": text_of(entry, "cap:description"),
-            "instruction": text_of(entry, "cap:instruction"),
-        }
-        entries.append(data)
-        
-    kml_tree = build_kml(entries)
-
-    # Pretty-print
-    ET.indent(kml_tree, space=" ", level=0)
-    kml_tree.write(out_path, encoding="utf-8", xml_declaration=True)
-    print(f"Wrote {out_path} with {len(entries)} placemarks", file=sys.stderr)
+        _start(g, 3, "Style")
+        _leaf(g, 4, "BalloonStyle", "") # presence triggers use of document balloon style
+        _end(g, 3, "Style")
+        _leaf(g, 3, "Snippet", e.headline or e.summary)
+
+        _start(g, 3, "ExtendedData")
+        for name, key in EXT_FIELDS:
+            _start(g, 4, "Data", {"name": name})
+            _leaf(g, 5, "value", getattr(e, key))
+            _end(g, 4, "Data")
+        _end(g, 3, "ExtendedData")
+
+        _start(g, 3, "Point")
+        _leaf(g, 4, "coordinates", f"{pt[1]},{pt[0]},0")
+        _end(g, 3, "Point")
+        _end(g, 2, "Placemark")
+
+    _end(g, 1, "Document")
+    _end(g, 0, "kml")
+    g.endDocument()
+
+def main(out_paths):
+    """Build every path in out_paths (.kml or .kmz) from one parse of the feed."""
+    body_path = fetch_cached(FEED_URL)
+    body_mtime = os.path.getmtime(body_path)
+    # Outputs are only ever replaced whole, so one newer than the body was built from it
+    stale = [p for p in out_paths if not (os.path.exists(p) and os.path.getmtime(p) >= body_mtime)]
+    if not stale:
+        print(f"Feed not modified; keeping {', '.join(out_paths)}", file=sys.stderr)
+        return
+
+    entries = {} # atom:id → newest entry seen with that id
+    no_id = [] # entries without an atom:id can't be matched up, so all are kept
+    with open(body_path, "rb") as src:
+        # Stream the feed: handle each entry once it is complete, then drop it
+        for _, entry in etree.iterparse(src, tag=Q_ENTRY, resolve_entities=False):
+            data = extract_entry(entry)
+            point = parse_point_from_entry(entry, data.areaDesc)
+            entry.clear(keep_tail=True)
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+            if not point:
+                continue # skip if we can't place it
+            data.point = point
+            if not data.id:
+                no_id.append(data)
+                continue
+            # Alerts can repeat; keep only the most recently updated copy
+            prev = entries.get(data.id)
+            if prev is None or is_newer(data, prev):
+                entries[data.id] = data
+    placemarks = [*entries.values(), *no_id]
+
+    for out_path in stale:
+        # Write beside the target and swap it in, so a failed run never leaves a partial file
+        tmp_path = out_path + ".tmp"
+        if out_path.endswith(".kmz"):
+            # KMZ is a zip archive holding the document as doc.kml
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as z, z.open("doc.kml", "w") as f:
+                write_kml(placemarks, f)
+        else:
+            with open(tmp_path, "wb") as f:
+                write_kml(placemarks, f)
+        os.replace(tmp_path, out_path)
+        print(f"Wrote {out_path} with {len(placemarks)} placemarks", file=sys.stderr)
 
 if __name__ == "__main__":
-    out = sys.argv[1] if len(sys.argv) > 1 else "site/alerts.kml"
-    main(out)
+    main(sys.argv[1:] or ["site/alerts.kml"])